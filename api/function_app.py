@@ -1,80 +1,409 @@
-import json
+import asyncio
+import hashlib
 import os
 import time
 import uuid
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
+from functools import lru_cache
+from types import MappingProxyType
 
 import azure.functions as func
 import httpx
-from pydantic import ValidationError
+import orjson
+from pydantic_core import ValidationError
 
 from src.auth import get_user_id_from_request
-from src.schemas import RoutineCreate, RoutineUpdate
 from src.security import validate_headers
 from src.supabase_admin import SupabaseAdmin
 
 app = func.FunctionApp(http_auth_level=func.AuthLevel.ANONYMOUS)
 
 
+def _env_int(name: str, default: int, *, min_value: int = 1, max_value: int | None = None) -> int:
+    raw = os.environ.get(name)
+    if raw is None:
+        return default
+
+    try:
+        value = int(raw)
+    except ValueError:
+        return default
+
+    if value < min_value:
+        return default
+    if max_value is not None and value > max_value:
+        return max_value
+    return value
+
+
+# App Settings não mudam durante a vida do worker: lê uma vez no import
+_SUPABASE_URL = os.environ.get("SUPABASE_URL", "").rstrip("/")
+_SERVICE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY", "")
+_SUPABASE_HEADERS = {"apikey": _SERVICE_KEY, "Authorization": f"Bearer {_SERVICE_KEY}"}
+_HTTP_TIMEOUT_S = float(os.getenv("HTTP_TIMEOUT_SECONDS") or os.getenv("ROUTINE_TIMEOUT_SECONDS") or "8")
+# Timeout por fase: connect/write/pool curtos (host fora do ar falha rápido), read = HTTP_TIMEOUT_SECONDS.
+# O read do httpx é por leitura (servidor "gotejando" passa dele): o teto real é _ROUTINE_DEADLINE_S.
+_HTTP_TIMEOUT = httpx.Timeout(
+    connect=min(2.0, _HTTP_TIMEOUT_S),
+    read=_HTTP_TIMEOUT_S,
+    write=min(2.0, _HTTP_TIMEOUT_S),
+    pool=min(2.0, _HTTP_TIMEOUT_S),
+)
+# 2 tentativas + espera do retry (máx 2s) + folga
+_ROUTINE_DEADLINE_S = 2 * _HTTP_TIMEOUT_S + 3
+
+# com vários worker processes na instância, o timer divide a máquina com o HTTP: default menor
+_WORKER_PROCS = _env_int("FUNCTIONS_WORKER_PROCESS_COUNT", 1, min_value=1, max_value=10)
+_MAX_CONCURRENCY = _env_int("MAX_CONCURRENCY", max(5, 20 // _WORKER_PROCS), min_value=1, max_value=200)
+# Pool do _HTTP: o scheduler inteiro + folga pros runs manuais (dividem o mesmo client).
+# _HTTP_SLOTS segura a rotina ANTES do deadline/cronômetro: esperar conexão livre é fila local,
+# não pode virar "timeout" (PoolTimeout) do endpoint do usuário.
+_HTTP_MAX_CONNECTIONS = _MAX_CONCURRENCY + 50
+_HTTP_SLOTS = asyncio.Semaphore(_HTTP_MAX_CONNECTIONS)
+
+
+# Validadores montados uma vez (chama o pydantic-core direto).
+# Lazy: pydantic + schemas custam ~100ms no cold start e só POST/PATCH precisam deles.
+@lru_cache(maxsize=None)
+def _routine_create_validator():
+    from pydantic import TypeAdapter
+    from src.schemas import RoutineCreate
+    return TypeAdapter(RoutineCreate)
+
+
+@lru_cache(maxsize=None)
+def _routine_update_validator():
+    from pydantic import TypeAdapter
+    from src.schemas import RoutineUpdate
+    return TypeAdapter(RoutineUpdate)
+
+
+# Clients HTTP reaproveitados entre invocações (worker quente não refaz TCP/TLS).
+# - _HTTP: chamadas para os endpoints das rotinas
+# - _SUPABASE_HTTP: ping do /health (pool separado, não disputa com as rotinas)
+# http2: rotinas no mesmo host multiplexam numa conexão só (ALPN cai pra HTTP/1.1 se o host não suportar)
+# trust_env=False: não consulta proxy/netrc do ambiente a cada request
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    timeout=_HTTP_TIMEOUT,
+    limits=httpx.Limits(max_connections=_HTTP_MAX_CONNECTIONS, max_keepalive_connections=50, keepalive_expiry=90),
+    trust_env=False,
+)
+_SUPABASE_HTTP = httpx.AsyncClient(
+    base_url=_SUPABASE_URL,
+    headers=_SUPABASE_HEADERS,
+    timeout=3.0,
+    limits=httpx.Limits(max_connections=4, max_keepalive_connections=2, keepalive_expiry=75),
+)
+
+
 # -------------------------
 # Helpers básicos
 # -------------------------
+# HttpResponse copia os headers: um mapping só (imutável) serve todas as respostas
+_NO_STORE_HEADERS = MappingProxyType({"Cache-Control": "no-store"})
+
+
 def _json(status: int, payload: dict) -> func.HttpResponse:
     return func.HttpResponse(
-        body=json.dumps(payload, ensure_ascii=False),
+        body=orjson.dumps(payload),
         status_code=status,
         mimetype="application/json",
-        headers={"Cache-Control": "no-store"},
+        headers=_NO_STORE_HEADERS,
     )
 
 
-def _now_iso() -> str:
-    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+def _etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match pode vir como lista ('"a", W/"b"') ou '*'; comparação fraca (ignora W/)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def _json_etag(req: func.HttpRequest, body: bytes, mimetype: str = "application/json") -> func.HttpResponse:
+    """
+    Resposta de leitura com ETag (hash do corpo): If-None-Match igual -> 304 sem corpo.
+    'no-cache' força revalidação, então o cliente nunca fica com dado velho após um PATCH.
+    """
+    etag = 'W/"' + hashlib.blake2b(body, digest_size=10).hexdigest() + '"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if _etag_matches(req.headers.get("If-None-Match"), etag):
+        return func.HttpResponse(status_code=304, headers=headers)
+
+    return func.HttpResponse(body=body, status_code=200, mimetype=mimetype, headers=headers)
+
+
+def _json_bytes(status: int, body: bytes) -> func.HttpResponse:
+    """Igual ao _json, mas com o corpo já serializado (respostas constantes)."""
+    return func.HttpResponse(
+        body=body,
+        status_code=status,
+        mimetype="application/json",
+        headers=_NO_STORE_HEADERS,
+    )
+
+
+def _validation_error(ve: ValidationError) -> func.HttpResponse:
+    """validate_json junta parse + schema: JSON quebrado mantém o erro de sempre (Invalid JSON body)."""
+    errors = ve.errors()
+    if errors and errors[0]["type"] == "json_invalid":
+        return _json_bytes(400, _ERR_INVALID_JSON)
+    return _json(400, {"error": {"code": "VALIDATION_ERROR", "details": errors}})
+
+
+def _error_body(code: str, message: str) -> bytes:
+    return orjson.dumps({"error": {"code": code, "message": message}})
+
+
+# Erros constantes: serializados uma vez no import
+_ERR_UNAUTHORIZED = _error_body("UNAUTHORIZED", "Missing/invalid Authorization Bearer token")
+_ERR_MISSING_ROUTINE_ID = _error_body("BAD_REQUEST", "Missing routine_id")
+_ERR_INVALID_JSON = _error_body("BAD_REQUEST", "Invalid JSON body")
+_ERR_BAD_LIMIT_RANGE = _error_body("BAD_REQUEST", "limit must be between 1 and 200")
+_ERR_BAD_LIMIT_TYPE = _error_body("BAD_REQUEST", "limit must be an integer")
+_ERR_NOT_FOUND = _error_body("NOT_FOUND", "Routine not found")
+_ERR_SECRET_REF_REQUIRED = _error_body("BAD_REQUEST", "secret_ref is required when auth_mode=SECRET_REF")
+
+_MAX_BODY_BYTES = 32 * 1024
+_ERR_PAYLOAD_TOO_LARGE = _error_body("PAYLOAD_TOO_LARGE", f"Body exceeds {_MAX_BODY_BYTES} bytes")
+_ERR_UNSUPPORTED_MEDIA_TYPE = _error_body("UNSUPPORTED_MEDIA_TYPE", "Content-Type must be application/json")
+
+
+def _reject_body(req: func.HttpRequest) -> func.HttpResponse | None:
+    """Barra corpo não-JSON ou grande demais antes de parsear/validar."""
+    content_type = (req.headers.get("Content-Type") or "").lower()
+    if not content_type.startswith("application/json"):
+        return _json_bytes(415, _ERR_UNSUPPORTED_MEDIA_TYPE)
+
+    try:
+        declared = int(req.headers.get("Content-Length") or 0)
+    except ValueError:
+        declared = 0
+    if declared > _MAX_BODY_BYTES or len(req.get_body()) > _MAX_BODY_BYTES:
+        return _json_bytes(413, _ERR_PAYLOAD_TOO_LARGE)
+
+    return None
+
 
+def _now_utc() -> datetime:
+    """Agora em UTC (sem micros). Vai cru nos payloads: orjson formata na borda."""
+    return datetime.fromtimestamp(int(time.time()), timezone.utc)
 
-def _truncate(s: str | None, max_len: int = 180) -> str | None:
+
+def _truncate(s: object, max_len: int = 180) -> str | None:
+    """Aceita str ou exception: só converte quando não é str."""
     if s is None:
         return None
-    s = str(s)
+    if not isinstance(s, str):
+        s = str(s)
     return s if len(s) <= max_len else s[:max_len]
 
 
-def _ping_supabase() -> dict:
-    """Ping simples via REST do Supabase usando service_role (backend only)."""
-    supabase_url = os.environ.get("SUPABASE_URL")
-    service_key = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
+# Health probes chegam em rajada: o resultado do ping vale por alguns segundos
+_PING_TTL_S = float(os.environ.get("HEALTH_PING_TTL_SECONDS", "5"))
+_PING_CACHE: tuple[float, dict] = (0.0, {})
+_PING_LOCK = asyncio.Lock()
 
-    if not supabase_url or not service_key:
-        return {"ok": False, "reason": "missing_env"}
 
-    url = f"{supabase_url.rstrip('/')}/rest/v1/workspaces?select=id&limit=1"
-    headers = {"apikey": service_key, "Authorization": f"Bearer {service_key}"}
+async def _ping_supabase() -> dict:
+    """Ping do Supabase com cache curto; misses concorrentes viram 1 chamada só."""
+    global _PING_CACHE
+
+    ts, cached = _PING_CACHE
+    if cached and time.monotonic() - ts < _PING_TTL_S:
+        return cached
+
+    async with _PING_LOCK:
+        ts, cached = _PING_CACHE
+        if cached and time.monotonic() - ts < _PING_TTL_S:
+            return cached
+
+        result = await _ping_supabase_uncached()
+        _PING_CACHE = (time.monotonic(), result)
+        return result
+
+
+async def _ping_supabase_uncached() -> dict:
+    """Ping simples via REST do Supabase usando service_role (backend only)."""
+    if not _SUPABASE_URL or not _SERVICE_KEY:
+        return {"ok": False, "reason": "missing_env"}
 
     try:
-        t0 = time.monotonic()
-        r = httpx.get(url, headers=headers, timeout=3.0)
-        elapsed_ms = int((time.monotonic() - t0) * 1000)
+        t0_ns = time.monotonic_ns()
+        r = await _SUPABASE_HTTP.get("/rest/v1/workspaces?select=id&limit=1")
+        elapsed_ms = (time.monotonic_ns() - t0_ns) // 1_000_000
         return {
             "ok": r.status_code == 200,
             "status_code": r.status_code,
             "latency_ms": elapsed_ms,
         }
     except Exception as e:
-        return {"ok": False, "error": _truncate(str(e), 200)}
+        return {"ok": False, "error": _truncate(e, 200)}
+
+
+_ADMIN: SupabaseAdmin | None = None
+
+# user_id -> (workspace_id, cached_at). O vínculo user -> workspace não muda,
+# então evita 1 round-trip no Supabase por request autenticado. LRU limitado.
+_WS_CACHE: OrderedDict[str, tuple[str, float]] = OrderedDict()
+_WS_CACHE_MAX = 10_000
+_WS_TTL_S = 3600.0
+
+
+def _admin() -> SupabaseAdmin:
+    """SupabaseAdmin único por worker (reaproveita o pool de conexões)."""
+    global _ADMIN
+    if _ADMIN is None:
+        _ADMIN = SupabaseAdmin()
+    return _ADMIN
+
+
+# Warm-init: monta o admin (client + headers) no import, antes do 1º request.
+# Sem env (ex.: indexação local) continua lazy e o erro aparece no 1º uso, como antes.
+if _SUPABASE_URL and _SERVICE_KEY:
+    _admin()
+
+
+async def _resolve_workspace(user_id: str) -> str:
+    now = time.monotonic()
+    cached = _WS_CACHE.get(user_id)
+    if cached and now - cached[1] < _WS_TTL_S:
+        _WS_CACHE.move_to_end(user_id)
+        return cached[0]
+
+    workspace_id = await _admin().get_or_create_workspace_id(user_id)
+    _WS_CACHE[user_id] = (workspace_id, now)
+    _WS_CACHE.move_to_end(user_id)
+    if len(_WS_CACHE) > _WS_CACHE_MAX:
+        _WS_CACHE.popitem(last=False)
+    return workspace_id
+
+
+# Runs manuais vão para uma fila; um flusher grava em lote (1 POST por lote).
+# Sem espera artificial: o que acumular enquanto um POST está em voo vai no próximo.
+_RUN_BATCH_MAX = 50
+_RUN_QUEUE: asyncio.Queue | None = None
+_RUN_FLUSHER: asyncio.Task | None = None
+
+
+async def _run_flusher(queue: asyncio.Queue) -> None:
+    while True:
+        batch = [await queue.get()]
+        while len(batch) < _RUN_BATCH_MAX and not queue.empty():
+            batch.append(queue.get_nowait())
+
+        admin = _admin()
+        try:
+            rows = await admin.insert_runs([payload for payload, _ in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                _settle(batch[0][1], error=e)
+            else:
+                # lote é tudo-ou-nada: uma linha ruim (ex.: rotina apagada no meio tempo)
+                # não pode derrubar os outros runs -> regrava 1 a 1, só o culpado recebe o erro
+                await asyncio.gather(*[_insert_run_single(admin, payload, fut) for payload, fut in batch])
+            continue
+
+        # casa pelo id (gerado no enfileiramento), não pela posição no array
+        by_id = {row.get("id"): row for row in rows}
+        for payload, fut in batch:
+            row = by_id.get(payload["id"])
+            if row is None:
+                _settle(fut, error=RuntimeError(f"Run {payload['id']} missing from bulk insert response"))
+            else:
+                _settle(fut, row)
+
+
+async def _insert_run_single(admin: SupabaseAdmin, payload: dict, fut: asyncio.Future) -> None:
+    try:
+        row = await admin.insert_run(payload)
+    except Exception as e:
+        _settle(fut, error=e)
+        return
+    _settle(fut, row)
+
+
+def _settle(fut: asyncio.Future, result: dict | None = None, error: Exception | None = None) -> None:
+    # request que desistiu (cancelado) já tem o future resolvido
+    if fut.done():
+        return
+    if error is not None:
+        fut.set_exception(error)
+    else:
+        fut.set_result(result)
+
+
+async def _insert_run_batched(payload: dict) -> dict:
+    """Enfileira o run e espera o resultado do lote em que ele foi gravado."""
+    global _RUN_QUEUE, _RUN_FLUSHER
+    if _RUN_FLUSHER is None or _RUN_FLUSHER.done():
+        _RUN_QUEUE = asyncio.Queue()
+        _RUN_FLUSHER = asyncio.create_task(_run_flusher(_RUN_QUEUE))
+
+    # id gerado aqui: o flusher devolve a cada future a sua linha
+    payload = {**payload, "id": str(uuid.uuid4())}
+    fut = asyncio.get_running_loop().create_future()
+    _RUN_QUEUE.put_nowait((payload, fut))
+    return await fut
+
+
+_EMPTY_HEADERS = MappingProxyType({})
+# 429/503: o upstream recusou antes de processar -> seguro repetir qualquer método.
+# 502/504: o upstream pode ter processado (gateway estourou depois) -> só repete GET/HEAD,
+# senão um POST de webhook dispararia 2x.
+_RETRY_ANY_METHOD = frozenset({429, 503})
+_RETRY_READ_ONLY = frozenset({502, 504})
+_READ_METHODS = frozenset({"GET", "HEAD"})
+_HTTP_METHODS = {
+    alias: m
+    for m in ("GET", "POST", "PUT", "PATCH", "DELETE", "HEAD")
+    for alias in (m, m.lower())
+}
+
+
+def _retry_after_seconds(r: httpx.Response, default: float = 0.5, cap: float = 2.0) -> float:
+    """Retry-After em segundos (limitado). Formato HTTP-date cai no default."""
+    raw = r.headers.get("Retry-After")
+    try:
+        delay = float(raw) if raw else default
+    except ValueError:
+        delay = default
+    return min(max(delay, 0.0), cap)
+
+
+# Snapshot dos SECRET_* no import (App Settings só mudam com restart do worker).
+# Indexado pelo nome curto (sem o prefixo): ref sem prefixo é 1 dict.get, sem montar string.
+_SECRETS = {k[len("SECRET_"):]: v for k, v in os.environ.items() if k.startswith("SECRET_")}
 
 
 def _get_secret_value(secret_ref: str | None) -> str | None:
     """
     Estratégia simples e segura:
     - Se secret_ref="GITHUB_TOKEN", busca env var "SECRET_GITHUB_TOKEN"
-    - Se secret_ref já vier "SECRET_GITHUB_TOKEN", usa direto.
+    - Se secret_ref já vier "SECRET_GITHUB_TOKEN", usa direto (só esse nome, sem outro fallback).
     """
     if not secret_ref:
         return None
+    if secret_ref.startswith("SECRET_"):
+        return _SECRETS.get(secret_ref[len("SECRET_"):])
+    return _SECRETS.get(secret_ref)
 
-    env_name = secret_ref if secret_ref.startswith("SECRET_") else f"SECRET_{secret_ref}"
-    return os.environ.get(env_name)
+
+@lru_cache(maxsize=256)
+def _parse_url(url: str) -> httpx.URL:
+    """Rotinas rodam sempre a mesma URL: parseia uma vez por worker."""
+    return httpx.URL(url)
 
 
 def _iso_to_dt(value: str | None) -> datetime | None:
@@ -85,7 +414,13 @@ def _iso_to_dt(value: str | None) -> datetime | None:
     """
     if not value:
         return None
-    v = value.strip()
+    return _parse_iso(value.strip())
+
+
+# Rotinas com o mesmo intervalo caem nos mesmos slots: o mesmo next_run_at se repete entre ticks.
+# datetime é imutável, então compartilhar o objeto cacheado é seguro.
+@lru_cache(maxsize=4096)
+def _parse_iso(v: str) -> datetime | None:
     if v.endswith("Z"):
         v = v[:-1] + "+00:00"
     try:
@@ -99,24 +434,7 @@ def _to_minute(dt: datetime) -> datetime:
     return dt.replace(second=0, microsecond=0)
 
 
-def _env_int(name: str, default: int, *, min_value: int = 1, max_value: int | None = None) -> int:
-    raw = os.environ.get(name)
-    if raw is None:
-        return default
-
-    try:
-        value = int(raw)
-    except ValueError:
-        return default
-
-    if value < min_value:
-        return default
-    if max_value is not None and value > max_value:
-        return max_value
-    return value
-
-
-def _compute_next_run_scheduled(routine: dict, now_dt: datetime) -> str:
+def _compute_next_run_scheduled(routine: dict, now_dt: datetime) -> datetime:
     """
     Calcula o próximo next_run_at para execução SCHEDULE sem drift.
 
@@ -135,125 +453,115 @@ def _compute_next_run_scheduled(routine: dict, now_dt: datetime) -> str:
     if anchor_dt.tzinfo is None:
         anchor_dt = anchor_dt.replace(tzinfo=timezone.utc)
 
-    next_dt = anchor_dt + timedelta(minutes=interval)
+    step = timedelta(minutes=interval)
+    next_dt = anchor_dt + step
 
-    while next_dt <= now_dt:
-        next_dt = next_dt + timedelta(minutes=interval)
+    # atraso longo (worker parado, outage): pula direto pro 1º slot no futuro, sem loop
+    if next_dt <= now_dt:
+        next_dt += step * ((now_dt - next_dt) // step + 1)
 
-    next_dt = _to_minute(next_dt)
-    return next_dt.isoformat()
+    return _to_minute(next_dt)
 
 
-def _execute_http_routine(routine: dict) -> dict:
+async def _send_with_retry(request: httpx.Request) -> httpx.Response:
+    r = await _HTTP.send(request)
+
+    # falha transitória: 1 retry sem bloquear o worker
+    if r.status_code in _RETRY_ANY_METHOD or (
+        r.status_code in _RETRY_READ_ONLY and request.method in _READ_METHODS
+    ):
+        await asyncio.sleep(_retry_after_seconds(r))
+        r = await _HTTP.send(request)
+    return r
+
+
+async def _execute_http_routine(routine: dict) -> dict:
     """
     Executa uma rotina do tipo HTTP_CHECK.
     Retorna sempre um dict com status/tempo/erro (não lança exception por HTTP != 2xx).
     """
-    timeout_s = float(os.getenv("HTTP_TIMEOUT_SECONDS") or os.getenv("ROUTINE_TIMEOUT_SECONDS") or "8")
+    # nunca mais requests em voo do que conexões no pool: o httpx não chega a esperar por conexão
+    async with _HTTP_SLOTS:
+        return await _execute_http_routine_slot(routine)
 
-    started = _now_iso()
-    t0 = time.monotonic()
+
+async def _execute_http_routine_slot(routine: dict) -> dict:
+    started = _now_utc()
+    t0_ns = time.monotonic_ns()
+
+    def _result(status: str, http_status: int | None, error_message: str | None) -> dict:
+        # relógios lidos 1x por execução
+        duration_ms = (time.monotonic_ns() - t0_ns) // 1_000_000
+        return {
+            "status": status,
+            "http_status": http_status,
+            "duration_ms": duration_ms,
+            "error_message": error_message,
+            "started_at": started,
+            "finished_at": _now_utc(),
+        }
 
     try:
-        method = (routine.get("http_method") or "GET").upper()
+        raw_method = routine.get("http_method") or "GET"
+        method = _HTTP_METHODS.get(raw_method) or raw_method.upper()
         url = routine.get("endpoint_url") or ""
-        headers = routine.get("headers_json") or {}
+        headers = routine.get("headers_json") or _EMPTY_HEADERS
 
+        token = None
         auth_mode = routine.get("auth_mode") or "NONE"
         if auth_mode == "SECRET_REF":
             token = _get_secret_value(routine.get("secret_ref"))
             if not token:
-                finished = _now_iso()
-                return {
-                    "status": "FAIL",
-                    "http_status": None,
-                    "duration_ms": int((time.monotonic() - t0) * 1000),
-                    "error_message": "missing_secret_ref_value",
-                    "started_at": started,
-                    "finished_at": finished,
-                }
-            headers = dict(headers)
-            headers["Authorization"] = f"Bearer {token}"
-
-        r = httpx.request(method, url, headers=headers, timeout=timeout_s)
-
-        finished = _now_iso()
-        duration_ms = int((time.monotonic() - t0) * 1000)
-
-        ok = 200 <= r.status_code < 300
-        if ok:
-            return {
-                "status": "SUCCESS",
-                "http_status": r.status_code,
-                "duration_ms": duration_ms,
-                "error_message": None,
-                "started_at": started,
-                "finished_at": finished,
-            }
+                return _result("FAIL", None, "missing_secret_ref_value")
 
-        return {
-            "status": "FAIL",
-            "http_status": r.status_code,
-            "duration_ms": duration_ms,
-            "error_message": _truncate(f"http_error:{r.status_code}", 180),
-            "started_at": started,
-            "finished_at": finished,
-        }
+        request = _HTTP.build_request(method, _parse_url(url), headers=headers, timeout=_HTTP_TIMEOUT)
+        if token:
+            # build_request já copiou os headers pro request: seta direto, sem dict(headers) extra
+            request.headers["Authorization"] = f"Bearer {token}"
+        r = await asyncio.wait_for(_send_with_retry(request), _ROUTINE_DEADLINE_S)
 
-    except httpx.TimeoutException:
-        finished = _now_iso()
-        return {
-            "status": "FAIL",
-            "http_status": None,
-            "duration_ms": int((time.monotonic() - t0) * 1000),
-            "error_message": "timeout",
-            "started_at": started,
-            "finished_at": finished,
-        }
+        if 200 <= r.status_code < 300:
+            return _result("SUCCESS", r.status_code, None)
+        return _result("FAIL", r.status_code, f"http_error:{r.status_code}")
+
+    except (httpx.TimeoutException, asyncio.TimeoutError):
+        return _result("FAIL", None, "timeout")
     except Exception as e:
-        finished = _now_iso()
-        return {
-            "status": "FAIL",
-            "http_status": None,
-            "duration_ms": int((time.monotonic() - t0) * 1000),
-            "error_message": _truncate(f"exception:{str(e)}", 180),
-            "started_at": started,
-            "finished_at": finished,
-        }
+        return _result("FAIL", None, _truncate(f"exception:{e}", 180))
 
 
 # -------------------------
 # HTTPS Helpers
 # -------------------------
 @app.route(route="health", methods=["GET"])
-def health(req: func.HttpRequest) -> func.HttpResponse:
+async def health(req: func.HttpRequest) -> func.HttpResponse:
     return _json(
         200,
         {
             "status": "ok",
             "service": "opspulse-api",
-            "supabase": _ping_supabase(),
+            "supabase": await _ping_supabase(),
         },
     )
 
 
 @app.route(route="routines", methods=["POST"])
-def create_routine(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def create_routine(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
-    try:
-        body = req.get_json()
-    except Exception:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Invalid JSON body"}})
+    rejected = _reject_body(req)
+    if rejected:
+        return rejected
 
     try:
-        data = RoutineCreate.model_validate(body)
+        # parse + validação direto dos bytes no pydantic-core (sem dict intermediário)
+        data = _routine_create_validator().validate_json(req.get_body())
         validate_headers(data.headers_json)
 
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
+        admin = _admin()
+        workspace_id = await _resolve_workspace(user_id)
 
         now = datetime.now(timezone.utc)
         next_run = _to_minute(now + timedelta(minutes=data.interval_minutes))
@@ -263,7 +571,7 @@ def create_routine(req: func.HttpRequest) -> func.HttpResponse:
             "name": data.name,
             "kind": data.kind,
             "interval_minutes": data.interval_minutes,
-            "next_run_at": next_run.isoformat(),
+            "next_run_at": next_run,
             "endpoint_url": str(data.endpoint_url),
             "http_method": data.http_method,
             "headers_json": data.headers_json,
@@ -271,158 +579,151 @@ def create_routine(req: func.HttpRequest) -> func.HttpResponse:
             "secret_ref": data.secret_ref,
         }
 
-        created = admin.insert_routine(payload)
+        created = await admin.insert_routine(payload)
         return _json(201, {"routine": created})
 
     except ValidationError as ve:
-        return _json(400, {"error": {"code": "VALIDATION_ERROR", "details": ve.errors()}})
+        return _validation_error(ve)
     except ValueError as ve:
         return _json(400, {"error": {"code": "BAD_REQUEST", "message": str(ve)}})
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 @app.route(route="routines", methods=["GET"])
-def list_routines(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def list_routines(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
     try:
         limit = int(req.params.get("limit", "50"))
         if limit < 1 or limit > 200:
-            return _json(400, {"error": {"code": "BAD_REQUEST", "message": "limit must be between 1 and 200"}})
+            return _json_bytes(400, _ERR_BAD_LIMIT_RANGE)
 
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
-        routines = admin.list_routines(workspace_id, limit=limit)
-        return _json(200, {"routines": routines})
+        admin = _admin()
+        workspace_id = await _resolve_workspace(user_id)
+        # array do PostgREST vai direto pro corpo: sem decode + re-encode de até 200 linhas
+        raw = await admin.list_routines_raw(workspace_id, limit=limit)
+        return _json_etag(req, b'{"routines":' + raw + b"}")
 
     except ValueError:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "limit must be an integer"}})
+        return _json_bytes(400, _ERR_BAD_LIMIT_TYPE)
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 @app.route(route="routines/{routine_id}", methods=["GET"])
-def get_routine(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def get_routine(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
     routine_id = req.route_params.get("routine_id")
     if not routine_id:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Missing routine_id"}})
+        return _json_bytes(400, _ERR_MISSING_ROUTINE_ID)
 
     try:
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
-        routine = admin.get_routine(workspace_id, routine_id)
+        routine = await _admin().get_routine_for_user(user_id, routine_id)
 
         if not routine:
-            return _json(404, {"error": {"code": "NOT_FOUND", "message": "Routine not found"}})
+            return _json_bytes(404, _ERR_NOT_FOUND)
 
-        return _json(200, {"routine": routine})
+        return _json_etag(req, orjson.dumps({"routine": routine}))
 
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 @app.route(route="routines/{routine_id}", methods=["PATCH"])
-def patch_routine(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def patch_routine(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
     routine_id = req.route_params.get("routine_id")
     if not routine_id:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Missing routine_id"}})
+        return _json_bytes(400, _ERR_MISSING_ROUTINE_ID)
 
-    try:
-        body = req.get_json()
-    except Exception:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Invalid JSON body"}})
+    rejected = _reject_body(req)
+    if rejected:
+        return rejected
 
     try:
-        data = RoutineUpdate.model_validate(body)
-        changes = data.model_dump(mode="json", exclude_unset=True, exclude_none=True)
-        if "endpoint_url" in changes:
-            changes["endpoint_url"] = str(changes["endpoint_url"])
+        validator = _routine_update_validator()
+        data = validator.validate_json(req.get_body())
+        # mode="json" já devolve endpoint_url como str
+        changes = validator.dump_python(data, mode="json", exclude_unset=True, exclude_none=True)
 
         if "headers_json" in changes:
             validate_headers(changes["headers_json"])
 
         if changes.get("auth_mode") == "SECRET_REF" and not changes.get("secret_ref"):
-            return _json(400, {"error": {"code": "BAD_REQUEST", "message": "secret_ref is required when auth_mode=SECRET_REF"}})
+            return _json_bytes(400, _ERR_SECRET_REF_REQUIRED)
 
         if "interval_minutes" in changes:
             next_run = datetime.now(timezone.utc) + timedelta(minutes=int(changes["interval_minutes"]))
-            changes["next_run_at"] = _to_minute(next_run).isoformat()
-
-        changes["updated_at"] = _now_iso()
+            changes["next_run_at"] = _to_minute(next_run)
 
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
+        changes["updated_at"] = _now_utc()
 
-        existing = admin.get_routine(workspace_id, routine_id)
-        if not existing:
-            return _json(404, {"error": {"code": "NOT_FOUND", "message": "Routine not found"}})
+        # PATCH condicional (id + workspace): sem linha de volta = 404
+        workspace_id = await _resolve_workspace(user_id)
+        updated = await _admin().update_routine(workspace_id, routine_id, changes)
+        if not updated:
+            return _json_bytes(404, _ERR_NOT_FOUND)
 
-        updated = admin.update_routine(workspace_id, routine_id, changes)
         return _json(200, {"routine": updated})
 
     except ValidationError as ve:
-        return _json(400, {"error": {"code": "VALIDATION_ERROR", "details": ve.errors()}})
+        return _validation_error(ve)
     except ValueError as ve:
         return _json(400, {"error": {"code": "BAD_REQUEST", "message": str(ve)}})
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 @app.route(route="routines/{routine_id}", methods=["DELETE"])
-def delete_routine(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def delete_routine(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
     routine_id = req.route_params.get("routine_id")
     if not routine_id:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Missing routine_id"}})
+        return _json_bytes(400, _ERR_MISSING_ROUTINE_ID)
 
     try:
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
+        workspace_id = await _resolve_workspace(user_id)
+        deleted = await _admin().delete_routine(workspace_id, routine_id)
+        if not deleted:
+            return _json_bytes(404, _ERR_NOT_FOUND)
 
-        existing = admin.get_routine(workspace_id, routine_id)
-        if not existing:
-            return _json(404, {"error": {"code": "NOT_FOUND", "message": "Routine not found"}})
-
-        admin.delete_routine(workspace_id, routine_id)
         return _json(200, {"deleted": True, "id": routine_id})
 
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 @app.route(route="routines/{routine_id}/run", methods=["POST"])
-def run_routine(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def run_routine(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
     routine_id = req.route_params.get("routine_id")
     if not routine_id:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Missing routine_id"}})
+        return _json_bytes(400, _ERR_MISSING_ROUTINE_ID)
 
     try:
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
+        admin = _admin()
 
-        routine = admin.get_routine(workspace_id, routine_id)
+        routine = await admin.get_routine_for_user(user_id, routine_id)
         if not routine:
-            return _json(404, {"error": {"code": "NOT_FOUND", "message": "Routine not found"}})
+            return _json_bytes(404, _ERR_NOT_FOUND)
 
-        result = _execute_http_routine(routine)
+        workspace_id = routine["workspace_id"]
+        result = await _execute_http_routine(routine)
 
         run_payload = {
             "routine_id": routine_id,
@@ -435,174 +736,222 @@ def run_routine(req: func.HttpRequest) -> func.HttpResponse:
             "finished_at": result["finished_at"],
         }
 
-        created_run = admin.insert_run(run_payload)
-
-        try:
-            admin.touch_last_run(workspace_id, routine_id, result["finished_at"])
-        except Exception:
-            pass
+        # as duas escritas são independentes: sobrepõe os round-trips
+        created_run, _ = await asyncio.gather(
+            _insert_run_batched(run_payload),
+            admin.touch_last_run(workspace_id, routine_id, result["finished_at"]),
+            return_exceptions=True,
+        )
+        if isinstance(created_run, Exception):
+            raise created_run
+        # falha no touch_last_run é ignorada (best-effort)
 
         return _json(200, {"run": created_run, "routine": {"id": routine_id, "last_run_at": result["finished_at"]}})
 
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 @app.route(route="routines/{routine_id}/runs", methods=["GET"])
-def list_runs(req: func.HttpRequest) -> func.HttpResponse:
-    user_id = get_user_id_from_request(req.headers.get("Authorization"))
+async def list_runs(req: func.HttpRequest) -> func.HttpResponse:
+    user_id = await get_user_id_from_request(req.headers.get("Authorization"))
     if not user_id:
-        return _json(401, {"error": {"code": "UNAUTHORIZED", "message": "Missing/invalid Authorization Bearer token"}})
+        return _json_bytes(401, _ERR_UNAUTHORIZED)
 
     routine_id = req.route_params.get("routine_id")
     if not routine_id:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "Missing routine_id"}})
+        return _json_bytes(400, _ERR_MISSING_ROUTINE_ID)
 
     try:
         limit = int(req.params.get("limit", "50"))
         if limit < 1 or limit > 200:
-            return _json(400, {"error": {"code": "BAD_REQUEST", "message": "limit must be between 1 and 200"}})
+            return _json_bytes(400, _ERR_BAD_LIMIT_RANGE)
 
-        admin = SupabaseAdmin()
-        workspace_id = admin.get_or_create_workspace_id(user_id)
+        admin = _admin()
 
-        routine = admin.get_routine(workspace_id, routine_id)
-        if not routine:
-            return _json(404, {"error": {"code": "NOT_FOUND", "message": "Routine not found"}})
+        # caminho comum (rotina com runs) = 1 chamada; só a lista vazia precisa checar se a rotina existe
+        runs = await admin.list_runs_for_user(user_id, routine_id, limit=limit)
+        if not runs and not await admin.get_routine_for_user(user_id, routine_id):
+            return _json_bytes(404, _ERR_NOT_FOUND)
+
+        if req.params.get("format") == "ndjson":
+            # 1 run por linha: o cliente consegue processar incrementalmente
+            body = b"".join(orjson.dumps(run, option=orjson.OPT_APPEND_NEWLINE) for run in runs)
+            return _json_etag(req, body, mimetype="application/x-ndjson")
 
-        runs = admin.list_runs(workspace_id, routine_id, limit=limit)
-        return _json(200, {"runs": runs})
+        return _json_etag(req, b'{"runs":' + orjson.dumps(runs) + b"}")
 
     except ValueError:
-        return _json(400, {"error": {"code": "BAD_REQUEST", "message": "limit must be an integer"}})
+        return _json_bytes(400, _ERR_BAD_LIMIT_TYPE)
     except Exception as e:
-        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(str(e), 200)}})
+        return _json(500, {"error": {"code": "INTERNAL", "message": _truncate(e, 200)}})
 
 
 # -------------------------
 # Scheduler (Timer Trigger)
 # -------------------------
-def _run_one_scheduled(routine: dict, locked_by: str) -> dict:
+
+# Env não muda durante a vida do worker: lê 1x no import
+_DUE_SLACK_SECONDS = _env_int("DUE_SLACK_SECONDS", 3, min_value=0, max_value=60)
+_LOCK_LEASE_SECONDS = _env_int("LOCK_LEASE_SECONDS", 45, min_value=5, max_value=3600)
+_SCHEDULER_BATCH_LIMIT = _env_int("SCHEDULER_BATCH_LIMIT", 20, min_value=1, max_value=200)
+_LOCKED_BY = os.environ.get("WEBSITE_INSTANCE_ID") or f"local-{uuid.uuid4().bytes[:4].hex()}"
+
+
+async def _run_one_scheduled(routine: dict) -> dict:
     """
-    Executa uma rotina já LOCKADA.
-    - Sempre tenta finalizar (soltar lock + next_run_at) quando tiver timestamps.
-    - Nunca deixa lock pendurado: fallback release_lock no finally (se existir).
+    Executa uma rotina já LOCKADA e devolve o que precisa ser gravado:
+    - run: payload do routine_runs
+    - next_run_at: próximo slot (None se algo falhou -> só solta o lock)
+    As escritas ficam com o scheduler (_finish_scheduled_one, assim que a rotina termina).
+    Nunca lança exception: toda rotina lockada precisa voltar pra ser finalizada.
     """
-    local_admin = SupabaseAdmin()
-    result = None
-    finished_at = None
-
     try:
-        result = _execute_http_routine(routine)
-        finished_at = result.get("finished_at") or _now_iso()
+        result = await _execute_http_routine(routine)
+        next_run = _compute_next_run_scheduled(routine, result["finished_at"])
 
-        now_dt = datetime.now(timezone.utc)
-        next_run = _compute_next_run_scheduled(routine, now_dt)
+        run_payload = {
+            "routine_id": routine["id"],
+            "triggered_by": "SCHEDULE",
+            "status": result["status"],
+            "http_status": result["http_status"],
+            "duration_ms": result["duration_ms"],
+            "error_message": result["error_message"],
+            "started_at": result["started_at"],
+            "finished_at": result["finished_at"],
+        }
+        return {"routine": routine, "run": run_payload, "next_run_at": next_run}
+
+    except Exception as e:
+        now_ts = _now_utc()
+        run_payload = {
+            "routine_id": routine["id"],
+            "triggered_by": "SCHEDULE",
+            "status": "FAIL",
+            "http_status": None,
+            "duration_ms": 0,
+            "error_message": _truncate(f"scheduler_error:{e}"),
+            "started_at": now_ts,
+            "finished_at": now_ts,
+        }
+        return {"routine": routine, "run": run_payload, "next_run_at": None}
 
-        try:
-            run_payload = {
-                "routine_id": routine["id"],
-                "triggered_by": "SCHEDULE",
-                "status": result["status"],
-                "http_status": result["http_status"],
-                "duration_ms": result["duration_ms"],
-                "error_message": result["error_message"],
-                "started_at": result["started_at"],
-                "finished_at": finished_at,
-            }
-            local_admin.insert_run(run_payload)
-        except Exception as e:
-            print(f"[scheduler] insert_run failed routine={routine['id']} err={_truncate(str(e), 200)}")
 
-        local_admin.finish_scheduled_run(
+async def _finish_scheduled_one(admin: SupabaseAdmin, outcome: dict, locked_by: str) -> None:
+    """
+    Finaliza 1 rotina assim que o check dela termina, em paralelo com os checks que ainda estão rodando.
+    - com a RPC finalize_scheduled_run: run + next_run_at + lock numa chamada/transação
+    - sem a RPC: grava o run ANTES de avançar next_run_at (histórico não some se o tick morrer no meio)
+    Nunca deixa lock pendurado: se finalizar falhar, tenta release_lock.
+    """
+    routine = outcome["routine"]
+    try:
+        if await admin.finalize_scheduled_run(
             workspace_id=routine["workspace_id"],
             routine_id=routine["id"],
             locked_by=locked_by,
-            last_run_at=finished_at,
-            next_run_at=next_run,
-        )
-
-        return {"id": routine["id"], "status": result["status"], "http_status": result["http_status"]}
+            run=outcome["run"],
+            next_run_at=outcome["next_run_at"],
+        ):
+            return
+    except Exception as e:
+        print(f"[scheduler] finalize rpc failed routine={routine['id']} err={_truncate(e, 200)}")
 
+    # 1 insert por rotina: uma linha ruim (ex.: rotina apagada no meio do tick) não leva as outras junto
+    try:
+        await admin.insert_run(outcome["run"])
     except Exception as e:
-        try:
-            now_iso = _now_iso()
-            local_admin.insert_run(
-                {
-                    "routine_id": routine["id"],
-                    "triggered_by": "SCHEDULE",
-                    "status": "FAIL",
-                    "http_status": None,
-                    "duration_ms": 0,
-                    "error_message": _truncate(f"scheduler_error:{str(e)}"),
-                    "started_at": now_iso,
-                    "finished_at": now_iso,
-                }
-            )
-        except Exception:
-            pass
+        print(f"[scheduler] insert_run failed routine={routine['id']} err={_truncate(e, 200)}")
 
-        raise
+    try:
+        if outcome["next_run_at"] is not None:
+            await admin.finish_scheduled_run(
+                workspace_id=routine["workspace_id"],
+                routine_id=routine["id"],
+                locked_by=locked_by,
+                last_run_at=outcome["run"]["finished_at"],
+                next_run_at=outcome["next_run_at"],
+            )
+            return
+    except Exception as e:
+        print(f"[scheduler] finish failed routine={routine['id']} err={_truncate(e, 200)}")
 
-    finally:
-        try:
-            if hasattr(local_admin, "release_lock"):
-                local_admin.release_lock(
-                    workspace_id=routine["workspace_id"],
-                    routine_id=routine["id"],
-                    locked_by=locked_by,
-                )
-        except Exception:
-            pass
+    try:
+        await admin.release_lock(
+            workspace_id=routine["workspace_id"],
+            routine_id=routine["id"],
+            locked_by=locked_by,
+        )
+    except Exception:
+        pass
 
 
 @app.schedule(schedule="0 */5 * * * *", arg_name="mytimer", run_on_startup=True, use_monitor=True)
-def scheduler(mytimer: func.TimerRequest) -> None:
-    now_dt = datetime.now(timezone.utc)
-    now_iso = now_dt.replace(microsecond=0).isoformat()
-
-    due_slack_seconds = _env_int("DUE_SLACK_SECONDS", 3, min_value=0, max_value=60)
-    due_iso = (now_dt + timedelta(seconds=due_slack_seconds)).replace(microsecond=0).isoformat()
-    lease_seconds = _env_int("LOCK_LEASE_SECONDS", 45, min_value=5, max_value=3600)
-    batch_limit = _env_int("SCHEDULER_BATCH_LIMIT", 20, min_value=1, max_value=200)
-    max_concurrency = _env_int("MAX_CONCURRENCY", 5, min_value=1, max_value=50)
+async def scheduler(mytimer: func.TimerRequest) -> None:
+    now_dt = _now_utc()
+    now_iso = now_dt.isoformat()
 
-    locked_by = os.environ.get("WEBSITE_INSTANCE_ID") or f"local-{uuid.uuid4().hex[:8]}"
+    due_iso = (now_dt + timedelta(seconds=_DUE_SLACK_SECONDS)).isoformat()
+    lease_seconds = _LOCK_LEASE_SECONDS
+    batch_limit = _SCHEDULER_BATCH_LIMIT
+    max_concurrency = _MAX_CONCURRENCY
+    locked_by = _LOCKED_BY
 
-    admin = SupabaseAdmin()
+    admin = _admin()
 
     try:
-        candidates = admin.list_due_routines(due_iso, limit=batch_limit)
-        if not candidates:
-            print(f"[scheduler] no due routines at now={now_iso} due_cutoff={due_iso}")
-            return
-
-        locked = []
-        for r in candidates:
-            got = admin.try_lock_routine(
-                workspace_id=r["workspace_id"],
-                routine_id=r["id"],
-                now_iso=now_iso,
-                lease_seconds=lease_seconds,
-                locked_by=locked_by,
+        locked = await admin.claim_due_routines(
+            now_iso=now_iso,
+            due_iso=due_iso,
+            lease_seconds=lease_seconds,
+            locked_by=locked_by,
+            limit=batch_limit,
+        )
+        if locked is None:
+            # banco sem a RPC: caminho antigo (lista + 1 PATCH de lock por rotina)
+            candidates = await admin.list_due_routines(due_iso, limit=batch_limit)
+            if not candidates:
+                print(f"[scheduler] no due routines at now={now_iso} due_cutoff={due_iso}")
+                return
+
+            # locks independentes (PATCH condicional por rotina): dispara todos juntos, mesmo lease pro lote
+            lock_until_iso = (now_dt + timedelta(seconds=lease_seconds)).isoformat()
+            attempts = await asyncio.gather(
+                *[
+                    admin.try_lock_routine(
+                        workspace_id=r["workspace_id"],
+                        routine_id=r["id"],
+                        now_iso=now_iso,
+                        lock_until_iso=lock_until_iso,
+                        locked_by=locked_by,
+                    )
+                    for r in candidates
+                ],
+                return_exceptions=True,
             )
-            if got:
-                locked.append(got)
+            locked = [got for got in attempts if got and not isinstance(got, BaseException)]
 
         if not locked:
-            print(f"[scheduler] candidates found but none locked (lock active / race) at now={now_iso} due_cutoff={due_iso}")
+            print(f"[scheduler] no routines locked (none due / lock active) at now={now_iso} due_cutoff={due_iso}")
             return
 
         print(f"[scheduler] locked {len(locked)} routines (batch_limit={batch_limit}, max_concurrency={max_concurrency})")
 
-        with ThreadPoolExecutor(max_workers=max_concurrency) as ex:
-            futures = [ex.submit(_run_one_scheduled, r, locked_by) for r in locked]
-            for f in as_completed(futures):
-                try:
-                    out = f.result()
-                    print(f"[scheduler] done routine={out['id']} status={out['status']} http={out['http_status']}")
-                except Exception as e:
-                    print(f"[scheduler] worker error: {_truncate(str(e), 200)}")
+        sem = asyncio.Semaphore(max_concurrency)
+
+        async def _bounded(routine: dict) -> dict:
+            async with sem:
+                return await _run_one_scheduled(routine)
+
+        pending = []
+        for fut in asyncio.as_completed([_bounded(r) for r in locked]):
+            out = await fut
+            pending.append(asyncio.create_task(_finish_scheduled_one(admin, out, locked_by)))
+            run = out["run"]
+            print(f"[scheduler] done routine={run['routine_id']} status={run['status']} http={run['http_status']}")
+
+        # a invocação não pode terminar com escrita pela metade
+        await asyncio.gather(*pending)
 
     except Exception as e:
-        print(f"[scheduler] fatal error: {_truncate(str(e), 200)}")
+        print(f"[scheduler] fatal error: {_truncate(e, 200)}")
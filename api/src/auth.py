@@ -1,17 +1,49 @@
+import base64
+import hashlib
 import os
+import time
+
 import httpx
+import orjson
 
 
 _AUTH_TIMEOUT_S = float(os.environ.get("AUTH_REQUEST_TIMEOUT_SECONDS", "10"))
-_AUTH_CLIENT = httpx.Client(timeout=_AUTH_TIMEOUT_S)
+_SUPABASE_URL = os.environ.get("SUPABASE_URL", "").rstrip("/")
+_ANON_KEY = os.environ.get("SUPABASE_ANON_KEY", "")
+
+# Client único por worker: base_url + apikey fixos, conexão TLS reaproveitada entre invocações
+_AUTH_CLIENT = httpx.AsyncClient(
+    base_url=_SUPABASE_URL,
+    headers={"apikey": _ANON_KEY},
+    timeout=_AUTH_TIMEOUT_S,
+    limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=75),
+)
 
+# blake2b(token) -> (user_id, expira_em). Nunca guarda o token cru.
+# TTL curto limita quanto tempo um token revogado no Supabase ainda passa por aqui.
+_AUTH_CACHE: dict[bytes, tuple[str, float]] = {}
+_AUTH_CACHE_MAX = 1024
+_AUTH_CACHE_TTL_S = float(os.environ.get("AUTH_CACHE_TTL_SECONDS", "60"))
 
-def get_user_id_from_request(auth_header: str | None) -> str | None:
+
+def _token_exp(token: str) -> float | None:
+    """Lê o 'exp' do payload do JWT (sem validar assinatura: só serve de TTL do cache)."""
+    try:
+        payload_b64 = token.split(".")[1]
+        payload_b64 += "=" * (-len(payload_b64) % 4)
+        exp = orjson.loads(base64.urlsafe_b64decode(payload_b64)).get("exp")
+        return float(exp) if exp is not None else None
+    except Exception:
+        return None
+
+
+async def get_user_id_from_request(auth_header: str | None) -> str | None:
     """
     Espera: Authorization: Bearer <access_token do Supabase>
     Faz uma chamada ao /auth/v1/user para validar e obter o user.id.
 
     Obs: precisa enviar 'apikey' junto (igual o supabase-js faz).
+    Tokens já validados ficam em cache por AUTH_CACHE_TTL_SECONDS (nunca além do 'exp' do JWT).
     """
     if not auth_header or not auth_header.lower().startswith("bearer "):
         return None
@@ -20,20 +52,25 @@ def get_user_id_from_request(auth_header: str | None) -> str | None:
     if not token:
         return None
 
-    supabase_url = os.environ.get("SUPABASE_URL", "").rstrip("/")
-    anon_key = os.environ.get("SUPABASE_ANON_KEY", "")
+    cache_key = hashlib.blake2b(token.encode(), digest_size=16).digest()
+    cached = _AUTH_CACHE.get(cache_key)
+    if cached:
+        if cached[1] > time.time():
+            return cached[0]
+        _AUTH_CACHE.pop(cache_key, None)
 
-    if not supabase_url or not anon_key:
+    if not _SUPABASE_URL or not _ANON_KEY:
         raise RuntimeError("Missing SUPABASE_URL or SUPABASE_ANON_KEY")
 
-    url = f"{supabase_url}/auth/v1/user"
-    headers = {
-        "apikey": anon_key,
-        "Authorization": f"Bearer {token}",
-    }
+    r = await _AUTH_CLIENT.get("/auth/v1/user", headers={"Authorization": f"Bearer {token}"})
 
-    r = _AUTH_CLIENT.get(url, headers=headers)
+    if r.status_code != 200:
+        return None
 
-    if r.status_code == 200:
-        return r.json().get("id")
-    return None
+    user_id = orjson.loads(r.content).get("id")
+    exp = _token_exp(token)
+    if user_id and exp and _AUTH_CACHE_TTL_S > 0:
+        if len(_AUTH_CACHE) >= _AUTH_CACHE_MAX:
+            _AUTH_CACHE.pop(next(iter(_AUTH_CACHE)))
+        _AUTH_CACHE[cache_key] = (user_id, min(exp, time.time() + _AUTH_CACHE_TTL_S))
+    return user_id
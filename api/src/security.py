@@ -1,19 +1,25 @@
-FORBIDDEN_HEADERS = {
+import re
+
+__all__ = ["FORBIDDEN_HEADERS", "validate_headers"]
+
+FORBIDDEN_HEADERS: frozenset[str] = frozenset({
     "authorization",
     "cookie",
     "set-cookie",
     "x-api-key",
     "x-auth-token",
-}
+})
 
 MAX_HEADER_NAME_LEN = 100
 MAX_HEADER_VALUE_LEN = 4096
 
 
+# RFC 7230 tchar (ASCII): compilado 1x, roda em C
+_HEADER_NAME_RE = re.compile(r"[A-Za-z0-9!#$%&'*+\-.^_`|~]+")
+
+
 def _is_valid_header_name(name: str) -> bool:
-    # RFC 7230 tchar simplificado
-    allowed = set("!#$%&'*+-.^_`|~")
-    return all(ch.isalnum() or ch in allowed for ch in name)
+    return _HEADER_NAME_RE.fullmatch(name) is not None
 
 
 def validate_headers(headers: dict) -> None:
@@ -22,6 +28,8 @@ def validate_headers(headers: dict) -> None:
 
     if not isinstance(headers, dict):
         raise ValueError("headers_json must be an object (key/value).")
+    if not headers:
+        return
 
     for k, v in headers.items():
         if not isinstance(k, str):
@@ -1,8 +1,48 @@
+import asyncio
 import os
-from datetime import datetime, timedelta
+from collections.abc import Mapping
+from datetime import datetime
+from types import MappingProxyType
 from typing import Any, Optional
 
 import httpx
+import orjson
+
+__all__ = ["SupabaseAdmin"]
+
+
+# Colunas que o scheduler usa pra executar/finalizar uma rotina (sem created_at, name, kind, ...)
+_SCHEDULER_SELECT = (
+    "id,workspace_id,interval_minutes,next_run_at,"
+    "endpoint_url,http_method,headers_json,auth_mode,secret_ref"
+)
+
+
+# Headers Prefer reaproveitados (imutáveis) em vez de um dict novo por chamada
+_PREFER_REPR = MappingProxyType({"Prefer": "return=representation"})
+_PREFER_REPR_IGNORE_DUPS = MappingProxyType({"Prefer": "return=representation,resolution=ignore-duplicates"})
+# escritas cujo retorno ninguém lê: PostgREST responde 204 sem montar/serializar as linhas
+_PREFER_MINIMAL = MappingProxyType({"Prefer": "return=minimal"})
+
+
+# Retry de falha transitória do edge do Supabase.
+# 429/503: recusado antes de processar, seguro pra qualquer método.
+# 502/504: o request pode ter chegado no banco, então só repete leitura (RPC/insert não são idempotentes).
+_RETRY_ANY_METHOD = frozenset({429, 503})
+_RETRY_READ_ONLY = frozenset({502, 504})
+_READ_METHODS = frozenset({"GET", "HEAD"})
+_MAX_RETRIES = 3
+_RETRY_CAP_S = 2.0
+
+
+def _retry_delay(r: httpx.Response, attempt: int) -> float:
+    """Retry-After (segundos) quando vier; senão backoff exponencial. Sempre limitado a _RETRY_CAP_S."""
+    raw = r.headers.get("Retry-After")
+    try:
+        delay = float(raw) if raw else 0.25 * (2 ** attempt)
+    except ValueError:  # formato HTTP-date
+        delay = 0.25 * (2 ** attempt)
+    return min(max(delay, 0.0), _RETRY_CAP_S)
 
 
 class SupabaseAdmin:
@@ -26,77 +66,125 @@ class SupabaseAdmin:
 
         # timeout padrão (pode ajustar via env se quiser)
         self.timeout_s = float(os.environ.get("SUPABASE_TIMEOUT_SECONDS", "10"))
-        self.client = httpx.Client(timeout=self.timeout_s)
+        # client único por admin (admin é singleton por worker): conexões ficam vivas entre invocações.
+        # http2: tudo vai pro mesmo host (SUPABASE_URL), então as chamadas concorrentes multiplexam num socket
+        # base_url: os métodos passam só o path ("/rest/v1/..."), o httpx junta com o host já parseado
+        # retries no transport: só refaz falha de conexão (connect), nunca um request que já foi enviado
+        self.client = httpx.AsyncClient(
+            base_url=self.supabase_url,
+            timeout=self.timeout_s,
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,
+                limits=httpx.Limits(max_connections=100, max_keepalive_connections=20, keepalive_expiry=75),
+            ),
+        )
 
-    def _req(
+        # viram False no 1º 404 da RPC (banco sem a função): para de tentar
+        self.has_claim_rpc = True
+        self.has_finalize_rpc = True
+
+    async def _req(
         self,
         method: str,
         path: str,
         params: Optional[dict[str, Any]] = None,
-        json: Optional[dict[str, Any]] = None,
-        extra_headers: Optional[dict[str, str]] = None,
+        json: Optional[dict[str, Any] | list[dict[str, Any]]] = None,
+        extra_headers: Optional[Mapping[str, str]] = None,
     ) -> httpx.Response:
-        url = f"{self.supabase_url}{path}"
-
-        headers = dict(self.base_headers)  # copia
-        if extra_headers:
-            headers.update(extra_headers)  # ✅ mescla (não sobrescreve)
-
-        return self.client.request(
-            method=method,
-            url=url,
-            headers=headers,
-            params=params,
-            json=json,
-        )
+        # sem extras (caso comum) usa o dict base direto: httpx não muta os headers recebidos
+        headers = {**self.base_headers, **extra_headers} if extra_headers else self.base_headers
+
+        # orjson: serializa datetime nativamente e já entrega bytes (1x, reaproveitado nos retries)
+        content = orjson.dumps(json) if json is not None else None
+
+        attempt = 0
+        while True:
+            r = await self.client.request(
+                method=method,
+                url=path,
+                headers=headers,
+                params=params,
+                content=content,
+            )
+            retryable = r.status_code in _RETRY_ANY_METHOD or (
+                r.status_code in _RETRY_READ_ONLY and method in _READ_METHODS
+            )
+            if not retryable or attempt >= _MAX_RETRIES:
+                return r
+            await asyncio.sleep(_retry_delay(r, attempt))
+            attempt += 1
 
     # -------------------------
     # Workspaces
     # -------------------------
-    def get_or_create_workspace_id(self, owner_id: str) -> str:
+    async def get_or_create_workspace_id(self, owner_id: str) -> str:
         # 1) tenta pegar workspace existente
-        r = self._req(
+        r = await self._req(
             "GET",
             "/rest/v1/workspaces",
             params={"owner_id": f"eq.{owner_id}", "select": "id", "limit": "1"},
         )
         if r.status_code == 200:
-            rows = r.json()
+            rows = orjson.loads(r.content)
             if rows:
                 return rows[0]["id"]
 
-        # 2) cria workspace
-        r2 = self._req(
+        # 2) cria workspace. Com UNIQUE(owner_id) no banco (ver docs/DB_OVERVIEW.md), dois logins
+        #    simultâneos não duplicam: o perdedor recebe [] (ignore-duplicates) e relê o vencedor.
+        r2 = await self._req(
             "POST",
             "/rest/v1/workspaces",
-            params={"select": "id"},
+            params={"on_conflict": "owner_id", "select": "id"},
             json={"owner_id": owner_id, "name": "My Workspace"},
-            extra_headers={"Prefer": "return=representation"},
+            extra_headers=_PREFER_REPR_IGNORE_DUPS,
         )
+        if r2.status_code == 400:
+            # banco sem a constraint (42P10): insert simples, como antes
+            r2 = await self._req(
+                "POST",
+                "/rest/v1/workspaces",
+                params={"select": "id"},
+                json={"owner_id": owner_id, "name": "My Workspace"},
+                extra_headers=_PREFER_REPR,
+            )
         if r2.status_code not in (200, 201):
             raise RuntimeError(f"Failed creating workspace: {r2.status_code} {r2.text[:200]}")
 
-        created = r2.json()
-        return created[0]["id"]
+        created = orjson.loads(r2.content)
+        if created:
+            return created[0]["id"]
+
+        # conflito: outro request criou no meio tempo
+        r3 = await self._req(
+            "GET",
+            "/rest/v1/workspaces",
+            params={"owner_id": f"eq.{owner_id}", "select": "id", "limit": "1"},
+        )
+        rows = orjson.loads(r3.content) if r3.status_code == 200 else []
+        if not rows:
+            raise RuntimeError(f"Failed resolving workspace after conflict: {r3.status_code} {r3.text[:200]}")
+        return rows[0]["id"]
 
     # -------------------------
     # Routines (CRUD)
     # -------------------------
-    def insert_routine(self, payload: dict) -> dict:
-        r = self._req(
+    async def insert_routine(self, payload: dict) -> dict:
+        r = await self._req(
             "POST",
             "/rest/v1/routines",
             params={"select": "*"},
             json=payload,
-            extra_headers={"Prefer": "return=representation"},
+            extra_headers=_PREFER_REPR,
         )
         if r.status_code not in (200, 201):
             raise RuntimeError(f"Failed inserting routine: {r.status_code} {r.text[:200]}")
-        rows = r.json()
+        rows = orjson.loads(r.content)
         return rows[0] if rows else {}
 
-    def list_routines(self, workspace_id: str, limit: int = 50) -> list[dict]:
-        r = self._req(
+    async def list_routines_raw(self, workspace_id: str, limit: int = 50) -> bytes:
+        """Devolve o JSON cru do PostgREST (repasse direto pro response, sem decode/encode)."""
+        r = await self._req(
             "GET",
             "/rest/v1/routines",
             params={
@@ -108,52 +196,65 @@ class SupabaseAdmin:
         )
         if r.status_code != 200:
             raise RuntimeError(f"Failed listing routines: {r.status_code} {r.text[:200]}")
-        return r.json()
+        return r.content
 
-    def get_routine(self, workspace_id: str, routine_id: str) -> Optional[dict]:
-        r = self._req(
+    async def get_routine_for_user(self, owner_id: str, routine_id: str) -> Optional[dict]:
+        """
+        Busca a rotina já filtrando pelo dono do workspace (inner join via PostgREST).
+        Evita resolver o workspace_id antes: 1 round-trip em vez de 2.
+        """
+        r = await self._req(
             "GET",
             "/rest/v1/routines",
             params={
                 "id": f"eq.{routine_id}",
-                "workspace_id": f"eq.{workspace_id}",
-                "select": "*",
+                "workspaces.owner_id": f"eq.{owner_id}",
+                "select": "*,workspaces!inner(owner_id)",
                 "limit": "1",
             },
         )
         if r.status_code != 200:
             raise RuntimeError(f"Failed getting routine: {r.status_code} {r.text[:200]}")
-        rows = r.json()
-        return rows[0] if rows else None
+        rows = orjson.loads(r.content)
+        if not rows:
+            return None
+
+        routine = rows[0]
+        routine.pop("workspaces", None)  # só serviu de filtro
+        return routine
 
-    def update_routine(self, workspace_id: str, routine_id: str, changes: dict) -> Optional[dict]:
-        r = self._req(
+    async def update_routine(self, workspace_id: str, routine_id: str, changes: dict) -> Optional[dict]:
+        r = await self._req(
             "PATCH",
             "/rest/v1/routines",
             params={"id": f"eq.{routine_id}", "workspace_id": f"eq.{workspace_id}", "select": "*"},
             json=changes,
-            extra_headers={"Prefer": "return=representation"},
+            extra_headers=_PREFER_REPR,
         )
         if r.status_code not in (200, 201):
             raise RuntimeError(f"Failed updating routine: {r.status_code} {r.text[:200]}")
-        rows = r.json()
+        rows = orjson.loads(r.content)
         return rows[0] if rows else None
 
-    def delete_routine(self, workspace_id: str, routine_id: str) -> None:
-        r = self._req(
+    async def delete_routine(self, workspace_id: str, routine_id: str) -> bool:
+        """Retorna False se nada foi apagado (rotina inexistente / de outro workspace)."""
+        r = await self._req(
             "DELETE",
             "/rest/v1/routines",
-            params={"id": f"eq.{routine_id}", "workspace_id": f"eq.{workspace_id}"},
+            params={"id": f"eq.{routine_id}", "workspace_id": f"eq.{workspace_id}", "select": "id"},
+            extra_headers=_PREFER_REPR,
         )
         if r.status_code not in (200, 204):
             raise RuntimeError(f"Failed deleting routine: {r.status_code} {r.text[:200]}")
+        return bool(orjson.loads(r.content)) if r.status_code == 200 else False
 
-    def touch_last_run(self, workspace_id: str, routine_id: str, iso_ts: str) -> None:
-        r = self._req(
+    async def touch_last_run(self, workspace_id: str, routine_id: str, ts: str | datetime) -> None:
+        r = await self._req(
             "PATCH",
             "/rest/v1/routines",
             params={"id": f"eq.{routine_id}", "workspace_id": f"eq.{workspace_id}"},
-            json={"last_run_at": iso_ts, "updated_at": iso_ts},
+            json={"last_run_at": ts, "updated_at": ts},
+            extra_headers=_PREFER_MINIMAL,
         )
         if r.status_code not in (200, 204):
             raise RuntimeError(f"Failed updating routine last_run_at: {r.status_code} {r.text[:200]}")
@@ -161,49 +262,67 @@ class SupabaseAdmin:
     # -------------------------
     # Runs (history)
     # -------------------------
-    def insert_run(self, payload: dict) -> dict:
-        r = self._req(
+    async def insert_run(self, payload: dict) -> dict:
+        r = await self._req(
             "POST",
             "/rest/v1/routine_runs",
             params={"select": "*"},
             json=payload,
-            extra_headers={"Prefer": "return=representation"},
+            extra_headers=_PREFER_REPR,
         )
         if r.status_code not in (200, 201):
             raise RuntimeError(f"Failed inserting run: {r.status_code} {r.text[:200]}")
-        rows = r.json()
+        rows = orjson.loads(r.content)
         return rows[0] if rows else {}
 
-    def list_runs(self, workspace_id: str, routine_id: str, limit: int = 50) -> list[dict]:
+    async def insert_runs(self, payloads: list[dict]) -> list[dict]:
+        """Bulk insert (PostgREST aceita array). Linhas voltam na ordem do payload."""
+        if not payloads:
+            return []
+        r = await self._req(
+            "POST",
+            "/rest/v1/routine_runs",
+            params={"select": "*"},
+            json=payloads,
+            extra_headers=_PREFER_REPR,
+        )
+        if r.status_code not in (200, 201):
+            raise RuntimeError(f"Failed inserting runs: {r.status_code} {r.text[:200]}")
+        return orjson.loads(r.content)
+
+    async def list_runs_for_user(self, owner_id: str, routine_id: str, limit: int = 50) -> list[dict]:
         """
-        workspace_id fica aqui por compatibilidade com seu código,
-        mas routine_runs normalmente não tem workspace_id.
-        A segurança real vem do fato de que você só consegue pegar routine_id
-        se a rotina pertencer ao workspace do usuário (feito no function_app).
+        Lista os runs já filtrando pelo dono (inner join routines -> workspaces): 1 round-trip.
+        Lista vazia não diz se a rotina existe: o caller confere com get_routine_for_user.
         """
-        r = self._req(
+        r = await self._req(
             "GET",
             "/rest/v1/routine_runs",
             params={
                 "routine_id": f"eq.{routine_id}",
-                "select": "*",
+                "routines.workspaces.owner_id": f"eq.{owner_id}",
+                "select": "*,routines!inner(workspaces!inner(owner_id))",
                 "order": "created_at.desc",
                 "limit": str(limit),
             },
         )
         if r.status_code != 200:
             raise RuntimeError(f"Failed listing runs: {r.status_code} {r.text[:200]}")
-        return r.json()
+        runs = orjson.loads(r.content)
+        for run in runs:
+            run.pop("routines", None)  # só serviu de filtro
+        return runs
 
     # -------------------------
     # Scheduler helpers
     # -------------------------
-    def list_due_routines(self, now_iso: str, limit: int = 20) -> list[dict]:
-        r = self._req(
+    async def list_due_routines(self, now_iso: str, limit: int = 20) -> list[dict]:
+        """Fallback do claim_due_routines (banco sem a RPC): lista sem lockear; lock vem depois, 1 PATCH por rotina."""
+        r = await self._req(
             "GET",
             "/rest/v1/routines",
             params={
-                "select": "*",
+                "select": _SCHEDULER_SELECT,
                 "is_active": "eq.true",
                 "next_run_at": f"lte.{now_iso}",
                 # sem lock ou lock expirado
@@ -214,75 +333,85 @@ class SupabaseAdmin:
         )
         if r.status_code != 200:
             raise RuntimeError(f"Failed listing due routines: {r.status_code} {r.text[:200]}")
-        return r.json()
+        return orjson.loads(r.content)
+
+    async def claim_due_routines(
+        self,
+        now_iso: str,
+        due_iso: str,
+        lease_seconds: int,
+        locked_by: str,
+        limit: int = 20,
+    ) -> Optional[list[dict]]:
+        """
+        Seleciona e lockeia as rotinas vencidas numa chamada só (RPC claim_due_routines,
+        FOR UPDATE SKIP LOCKED — ver docs/DB_OVERVIEW.md).
+        None = RPC não existe no banco (caller cai no list_due_routines + try_lock_routine).
+        """
+        if not self.has_claim_rpc:
+            return None
 
-    def try_lock_routine(
+        r = await self._req(
+            "POST",
+            "/rest/v1/rpc/claim_due_routines",
+            params={"select": _SCHEDULER_SELECT},
+            json={
+                "p_now": now_iso,
+                "p_due": due_iso,
+                "p_lease_seconds": lease_seconds,
+                "p_locked_by": locked_by,
+                "p_limit": limit,
+            },
+        )
+        if r.status_code == 404:
+            self.has_claim_rpc = False
+            return None
+        if r.status_code != 200:
+            raise RuntimeError(f"Failed claiming due routines: {r.status_code} {r.text[:200]}")
+        return orjson.loads(r.content)
+
+    async def try_lock_routine(
         self,
         workspace_id: str,
         routine_id: str,
         now_iso: str,
-        lease_seconds: int,
+        lock_until_iso: str,
         locked_by: str,
     ) -> Optional[dict]:
-        now_dt = datetime.fromisoformat(now_iso)
-        lock_until = (now_dt + timedelta(seconds=lease_seconds)).isoformat()
-
-        r = self._req(
+        """
+        Fallback do claim_due_routines: lock otimista (PATCH condicional). None = outro worker pegou antes.
+        lock_until_iso vem pronto do caller (calculado 1x por tick, igual pra todo o lote).
+        """
+        r = await self._req(
             "PATCH",
             "/rest/v1/routines",
             params={
                 "id": f"eq.{routine_id}",
                 "workspace_id": f"eq.{workspace_id}",
                 "or": f"(lock_until.is.null,lock_until.lt.{now_iso})",
-                "select": "*",
-            },
-            json={"lock_until": lock_until, "locked_by": locked_by, "updated_at": now_iso},
-            extra_headers={
-                "Prefer": "return=representation",
-                "Accept": "application/json",
+                "select": _SCHEDULER_SELECT,
             },
+            json={"lock_until": lock_until_iso, "locked_by": locked_by, "updated_at": now_iso},
+            extra_headers=_PREFER_REPR,
         )
 
         if r.status_code not in (200, 201, 204):
             raise RuntimeError(f"Failed locking routine: {r.status_code} {r.text[:200]}")
 
-        # 1) caminho ideal: veio a linha no body
-        try:
-            rows = r.json() if r.text else []
-        except Exception:
-            rows = []
-
-        if rows:
-            return rows[0]
-
-        # 2) fallback: confirma no banco se o lock foi aplicado
-        check = self._req(
-            "GET",
-            "/rest/v1/routines",
-            params={
-                "id": f"eq.{routine_id}",
-                "workspace_id": f"eq.{workspace_id}",
-                "locked_by": f"eq.{locked_by}",
-                "select": "*",
-                "limit": "1",
-            },
-        )
-        if check.status_code == 200:
-            got = check.json()
-            return got[0] if got else None
-
-        return None
+        # return=representation: array vazio = o filtro não casou (lock já tomado)
+        rows = orjson.loads(r.content) if r.content else []
+        return rows[0] if rows else None
 
 
-    def finish_scheduled_run(
+    async def finish_scheduled_run(
         self,
         workspace_id: str,
         routine_id: str,
         locked_by: str,
-        last_run_at: str,
-        next_run_at: str,
+        last_run_at: str | datetime,
+        next_run_at: str | datetime,
     ) -> None:
-        r = self._req(
+        r = await self._req(
             "PATCH",
             "/rest/v1/routines",
             params={
@@ -297,12 +426,48 @@ class SupabaseAdmin:
                 "locked_by": None,
                 "updated_at": last_run_at,
             },
+            extra_headers=_PREFER_MINIMAL,
         )
         if r.status_code not in (200, 204):
             raise RuntimeError(f"Failed finishing scheduled run: {r.status_code} {r.text[:200]}")
 
-    def release_lock(self, workspace_id: str, routine_id: str, locked_by: str) -> None:
-        r = self._req(
+    async def finalize_scheduled_run(
+        self,
+        workspace_id: str,
+        routine_id: str,
+        locked_by: str,
+        run: dict,
+        next_run_at: Optional[str | datetime],
+    ) -> bool:
+        """
+        Insert do run + next_run_at/last_run_at + solta lock numa transação só
+        (RPC finalize_scheduled_run — ver docs/DB_OVERVIEW.md).
+        next_run_at None = só grava o run e solta o lock (rotina continua devida).
+        False = RPC não existe no banco (caller usa insert_runs + finish_scheduled_run).
+        """
+        if not self.has_finalize_rpc:
+            return False
+
+        r = await self._req(
+            "POST",
+            "/rest/v1/rpc/finalize_scheduled_run",
+            json={
+                "p_workspace_id": workspace_id,
+                "p_routine_id": routine_id,
+                "p_locked_by": locked_by,
+                "p_run": run,
+                "p_next_run_at": next_run_at,
+            },
+        )
+        if r.status_code == 404:
+            self.has_finalize_rpc = False
+            return False
+        if r.status_code not in (200, 204):
+            raise RuntimeError(f"Failed finalizing scheduled run: {r.status_code} {r.text[:200]}")
+        return True
+
+    async def release_lock(self, workspace_id: str, routine_id: str, locked_by: str) -> None:
+        r = await self._req(
             "PATCH",
             "/rest/v1/routines",
             params={
@@ -311,6 +476,7 @@ class SupabaseAdmin:
                 "locked_by": f"eq.{locked_by}",
             },
             json={"lock_until": None, "locked_by": None},
+            extra_headers=_PREFER_MINIMAL,
         )
         if r.status_code not in (200, 204):
             raise RuntimeError(f"Failed releasing lock: {r.status_code} {r.text[:200]}")
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# function_app.py e src/ ficam na raiz de api/ (layout do Azure Functions)
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,73 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from function_app import _compute_next_run_scheduled
+
+NOW = datetime(2026, 1, 10, 12, 0, tzinfo=timezone.utc)
+
+
+def _reference(anchor: datetime, interval: int, now: datetime) -> datetime:
+    """Versão antiga (loop de 1 em 1 intervalo): o salto O(1) tem que bater com ela."""
+    step = timedelta(minutes=interval)
+    next_dt = anchor + step
+    while next_dt <= now:
+        next_dt += step
+    return next_dt.replace(second=0, microsecond=0)
+
+
+def _routine(anchor: datetime | None, interval: int = 5) -> dict:
+    return {
+        "interval_minutes": interval,
+        "next_run_at": anchor.isoformat() if anchor is not None else None,
+    }
+
+
+def test_on_time_advances_one_interval():
+    assert _compute_next_run_scheduled(_routine(NOW), NOW) == NOW + timedelta(minutes=5)
+
+
+def test_lagged_seven_days_jumps_to_first_future_slot():
+    anchor = NOW - timedelta(days=7, minutes=2)
+    got = _compute_next_run_scheduled(_routine(anchor), NOW)
+
+    assert got == _reference(anchor, 5, NOW)
+    assert NOW < got <= NOW + timedelta(minutes=5)
+    assert (got - anchor) % timedelta(minutes=5) == timedelta(0)
+
+
+@pytest.mark.parametrize("interval", [5, 7, 60, 1440])
+@pytest.mark.parametrize("multiple", [1, 2, 3, 2016])
+def test_exact_boundary_lag_lands_strictly_after_now(interval, multiple):
+    # delta % interval == 0: anchor + k*interval cai exatamente em now, que não conta como futuro
+    anchor = NOW - timedelta(minutes=interval * multiple)
+    got = _compute_next_run_scheduled(_routine(anchor, interval), NOW)
+
+    assert got == NOW + timedelta(minutes=interval)
+    assert got == _reference(anchor, interval, NOW)
+
+
+@pytest.mark.parametrize("interval", [5, 7, 60])
+@pytest.mark.parametrize("lag_minutes", [0, 1, 4, 5, 6, 59, 60, 61, 10079, 10080, 10081])
+def test_matches_reference_around_boundaries(interval, lag_minutes):
+    anchor = NOW - timedelta(minutes=lag_minutes)
+    got = _compute_next_run_scheduled(_routine(anchor, interval), NOW)
+
+    assert got == _reference(anchor, interval, NOW)
+
+
+def test_seconds_are_truncated_to_the_minute():
+    anchor = NOW - timedelta(days=7, seconds=30)
+    now = NOW + timedelta(seconds=45)
+    got = _compute_next_run_scheduled(_routine(anchor), now)
+
+    assert got.second == 0 and got.microsecond == 0
+    assert got == _reference(anchor, 5, now)
+
+
+def test_z_suffix_and_missing_anchor():
+    z_anchor = {"interval_minutes": 5, "next_run_at": "2026-01-03T12:00:00Z"}
+    assert _compute_next_run_scheduled(z_anchor, NOW) == NOW + timedelta(minutes=5)
+
+    # sem next_run_at: ancora em now
+    assert _compute_next_run_scheduled(_routine(None), NOW) == NOW + timedelta(minutes=5)